@@ -27,17 +27,18 @@ import sys
 import os
 import argparse
 from os import listdir
-from os.path import isfile, join
 from pathlib import Path
-import subprocess
+import traceback
+import tempfile
+import fcntl
 import multiprocessing as mp
-from ete3 import NCBITaxa
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from io import StringIO
-import re
 import shutil
 from tqdm import tqdm
 from datetime import datetime
+import fdog.addTaxon as addTaxonFn
 
 
 def checkFileExist(file):
@@ -45,58 +46,137 @@ def checkFileExist(file):
         sys.exit('%s not found' % file)
 
 
-def getTaxName(taxId):
-    ncbi = NCBITaxa()
-    try:
-        ncbiName = ncbi.get_taxid_translator([taxId])[int(taxId)]
-        ncbiName = re.sub('[^a-zA-Z1-9\\s]+', '', ncbiName)
-        taxName = ncbiName.split()
-        name = taxName[0][:3].upper() + taxName[1][:2].upper()
-    except BaseException:
-        name = "UNK" + taxId
-    return(name)
-
-
 def parseMapFile(mappingFile):
     nameDict = {}
-    with open(mappingFile) as f:
-        for line in f:
-            if '#' not in line:
-                tmp = line.split('\t')
-                fileName = tmp[0]
-                taxId = tmp[1].strip()
-                try:
-                    taxName = tmp[2].strip()
-                except BaseException:
-                    taxName = getTaxName(taxId)
-                try:
-                    ver = tmp[3].strip()
-                except BaseException:
-                    ver = datetime.today().strftime('%y%m%d')  # 1
-                # print(taxName+"@"+str(taxId)+"@"+str(ver))
-                nameDict[fileName] = (taxName, str(taxId), str(ver))
+    missingName = []
+    with open(mappingFile, newline='') as f:
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if not row or row[0].startswith('#'):
+                continue
+            fileName = row[0]
+            taxId = row[1].strip()
+            if len(row) > 2:
+                taxName = row[2].strip()
+            else:
+                taxName = None
+                missingName.append(taxId)
+            if len(row) > 3:
+                ver = row[3].strip()
+            else:
+                ver = datetime.today().strftime('%y%m%d')  # 1
+            # print(taxName+"@"+str(taxId)+"@"+str(ver))
+            nameDict[fileName] = (taxName, str(taxId), str(ver))
+    # get missing taxon names from NCBI in one go
+    if len(missingName) > 0:
+        taxNames = addTaxonFn.getTaxNames(missingName)
+        for fileName, (taxName, taxId, ver) in nameDict.items():
+            if taxName is None:
+                nameDict[fileName] = (taxNames[taxId], taxId, ver)
     return(nameDict)
 
 
+def removeData(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        return(True)
+    except OSError as e:
+        print('\033[91mProblem with removing %s: %s\033[0m' % (path, e))
+        return(False)
+
+
+def waitForRemoval(jobs, delJobs, notRemoved):
+    # hold back each job until its old data have been removed; jobs whose
+    # old data could not be removed are not run but added to notRemoved
+    for job in jobs:
+        removed = [delJob.result() for delJob in delJobs.get(job[0], [])]
+        if all(removed):
+            yield(job)
+        else:
+            notRemoved.append(job[0])
+
+
+def initWorker(logPath, ncbiInfo=None):
+    # taxonomy info resolved by the parent process, so that workers do not
+    # need to open the NCBI taxonomy database themselves
+    global taxInfo, logFile
+    taxInfo = ncbiInfo
+    logFile = logPath
+    sys.stdout.reconfigure(line_buffering=True)
+
+
+def runLogged(function, args):
+    # collect the output of one job (incl. its subprocesses) in a temp file
+    # and append it to the log file in one locked write, so that outputs of
+    # parallel jobs do not interleave
+    with tempfile.TemporaryFile() as jobLog:
+        os.dup2(jobLog.fileno(), sys.stdout.fileno())
+        os.dup2(jobLog.fileno(), sys.stderr.fileno())
+        try:
+            return(function(args))
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            jobLog.seek(0)
+            with open(logFile, 'ab') as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                shutil.copyfileobj(jobLog, log)
+                log.flush()
+                fcntl.flock(log, fcntl.LOCK_UN)
+
+
 def runAddTaxon(args):
-    (f, n, i, o, c, v, a, cpus, replace, delete) = args
-    cmd = 'fdog.addTaxon -f %s -n %s -i %s -o %s -v %s --cpus %s' % (
-        f, n, i, o, v, cpus)
+    return(runLogged(addTaxonJob, args))
+
+
+def runBlast(args):
+    return(runLogged(blastDbJob, args))
+
+
+def addTaxonJob(args):
+    (f, n, i, o, c, v, a, cpus, replace, delete, assumeClean) = args
+    cmd = ['-f', f, '-n', n, '-i', i, '-o', o, '-v', v, '--cpus', str(cpus)]
     if c:
-        cmd = cmd + ' -c'
+        cmd.append('-c')
     if a:
-        cmd = cmd + ' -a'
+        cmd.append('-a')
     if replace:
-        cmd = cmd + ' --replace'
+        cmd.append('--replace')
     if delete:
-        cmd = cmd + ' --delete'
-    # print(cmd)
-    logFile = o + '/addTaxa2fDog.log'
-    cmd = cmd + ' >> ' + logFile
+        cmd.append('--delete')
+    if assumeClean:
+        cmd.append('--assumeClean')
+    # return input file, success status and blast job (if any)
+    try:
+        blastJob = addTaxonFn.run(
+            addTaxonFn.getParser().parse_args(cmd), makeBlast=False,
+            taxInfo=taxInfo)
+        return(f, True, blastJob)
+    except SystemExit as e:
+        if not e.code:
+            return(f, True, None)
+        print('\033[91mProblem with adding %s: %s\033[0m' % (f, e.code),
+              file=sys.stderr)
+    except Exception:
+        print('\033[91mProblem with adding %s\033[0m' % f, file=sys.stderr)
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+    return(f, False, None)
+
+
+def blastDbJob(args):
     try:
-        subprocess.call([cmd], shell=True)
+        addTaxonFn.runBlast(args)
+        return(True)
     except BaseException:
-        sys.exit('Problem running\n%s' % (cmd))
+        print('\033[91mProblem with creating BlastDB for %s.\033[0m' %
+              args[0], file=sys.stderr)
+        return(False)
+    finally:
+        sys.stdout.flush()
 
 
 def main():
@@ -141,7 +221,7 @@ def main():
         default=False)
     optional.add_argument(
         '--cpus',
-        help='Number of CPUs used for annotation. Default = available cores - 1',
+        help='Number of CPUs used for annotating each taxon. Default = available cores - 1, shared between taxa processed in parallel',
         action='store',
         default=0,
         type=int)
@@ -155,6 +235,11 @@ def main():
         help='Delete special characters in sequences',
         action='store_true',
         default=False)
+    optional.add_argument(
+        '--assumeClean',
+        help='Do not check sequences for special characters',
+        action='store_true',
+        default=False)
     optional.add_argument(
         '-f',
         '--force',
@@ -180,16 +265,15 @@ def main():
     noAnno = args.noAnno
     coreTaxa = args.coreTaxa
     cpus = args.cpus
-    if cpus == 0:
-        cpus = mp.cpu_count() - 2
     replace = args.replace
     delete = args.delete
+    assumeClean = args.assumeClean
     force = args.force
 
     # get existing genomes
     Path(outPath + "/genome_dir").mkdir(parents=True, exist_ok=True)
     Path(outPath + "/weight_dir").mkdir(parents=True, exist_ok=True)
-    genomeFiles = listdir(outPath + "/genome_dir")
+    genomeFiles = set(listdir(outPath + "/genome_dir"))
 
     # generate taxon names from mapping file
     nameDict = parseMapFile(mapping)
@@ -197,7 +281,10 @@ def main():
     # read all input fasta files and create addTaxon jobs
     jobs = []
     dupList = {}
-    faFiles = [f for f in listdir(folIn) if isfile(join(folIn, f))]
+    # old data of duplicated taxa are removed in background threads
+    delPool = ThreadPoolExecutor(max_workers=8)
+    delJobs = {}
+    faFiles = [e.name for e in os.scandir(folIn) if e.is_file()]
     for f in faFiles:
         # tmp = f.split('.')
         if f in nameDict:
@@ -206,9 +293,12 @@ def main():
             flag = 1
             if taxName in genomeFiles:
                 if force:
-                    shutil.rmtree(outPath + "/genome_dir/" + taxName)
+                    delJobs[folIn + '/' + f] = [delPool.submit(
+                        removeData, outPath + "/genome_dir/" + taxName)]
                     if not noAnno:
-                        shutil.rmtree(outPath + "/weight_dir/" + taxName)
+                        delJobs[folIn + '/' + f].append(delPool.submit(
+                            removeData,
+                            outPath + "/weight_dir/" + taxName + '.json'))
                 else:
                     flag = 0
                 dupList[f] = taxName
@@ -227,7 +317,8 @@ def main():
                              noAnno,
                              cpus,
                              replace,
-                             delete])
+                             delete,
+                             assumeClean])
 
     if len(dupList) > 0:
         print(
@@ -242,11 +333,61 @@ def main():
                 "Please remove them from the mapping file or use different Name/ID/Version!")
 
     print('Parsing...')
-    for job in tqdm(jobs):
-        # print('@'.join([job[1],job[2],job[5]]) + '\t' + job[0])
-        runAddTaxon(job)
+    # run several addTaxon jobs in parallel; without --cpus the available
+    # cores are split between the jobs, with --cpus each job uses that many
+    if noAnno:
+        nJobs = max(1, min(len(jobs), mp.cpu_count()))
+    elif cpus == 0:
+        nJobs = max(1, min(len(jobs), mp.cpu_count() - 1))
+        cpus = max(1, (mp.cpu_count() - 1) // nJobs)
+    else:
+        nJobs = max(1, min(len(jobs), (mp.cpu_count() - 1) // cpus))
+    for job in jobs:
+        job[7] = cpus
+    # start with the largest gene sets to avoid a long tail of single jobs
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+    logFile = outPath + '/addTaxa2fDog.log'
+    blastJobs = []
+    failed = []
+    taxIds = set(str(int(job[2])) for job in jobs if job[2].isdigit())
+    taxInfo = {}
+    if len(taxIds) > 0:
+        taxInfo = addTaxonFn.getTaxInfo(list(taxIds))
+    # workers are started from a fork server, not forked from this process
+    # which may still run threads that remove old data
+    ctx = mp.get_context('forkserver')
+    with ctx.Pool(
+            nJobs, initializer=initWorker,
+            initargs=(logFile, taxInfo)) as pool:
+        with tqdm(total=len(jobs)) as pbar:
+            for (f, success, blastJob) in pool.imap_unordered(
+                    runAddTaxon, waitForRemoval(jobs, delJobs, failed)):
+                pbar.update(1)
+                if not success:
+                    failed.append(f)
+                elif blastJob:
+                    blastJobs.append(blastJob)
+            # jobs skipped because their old data could not be removed
+            pbar.update(len(jobs) - pbar.n)
+    delPool.shutdown()
+
+    # create blast DBs for all core taxa at once
+    if len(blastJobs) > 0:
+        print('Creating Blast DBs...')
+        nJobs = min(len(blastJobs), mp.cpu_count())
+        with ctx.Pool(nJobs, initializer=initWorker, initargs=(logFile,)) as pool:
+            for blastJob, success in zip(
+                    blastJobs, pool.map(runBlast, blastJobs)):
+                if not success:
+                    failed.append('Blast DB of ' + blastJob[0])
 
     print('Output can be found in %s' % outPath)
+    if len(failed) > 0:
+        print('\033[91mProblem with adding these taxa:\033[0m')
+        for f in failed:
+            print('\033[91m\t%s\033[0m' % f)
+        sys.exit(
+            '\033[91mPlease check %s for details!\033[0m' % logFile)
 
 
 if __name__ == '__main__':
@@ -27,14 +27,23 @@ import sys
 import os
 import argparse
 from pathlib import Path
-from Bio import SeqIO
 import subprocess
 import multiprocessing as mp
-from ete3 import NCBITaxa
 import re
 import shutil
+import string
+import mmap
 from datetime import datetime
 
+ncbiTaxa = None
+taxNamePattern = re.compile('[^a-zA-Z1-9\\s]+')
+cleanFastaPattern = re.compile(b'(?:>[^\\s|]+\\n[A-Za-z]+\\n)+')
+headerPattern = re.compile(b'>([^\\n]*)')
+# byte tables for checking and cleaning sequences
+alphaChr = string.ascii_letters.encode()
+nonAlphaChr = bytes(c for c in range(256) if c not in alphaChr)
+replaceTable = bytes(c if c in alphaChr else ord('X') for c in range(256))
+
 
 def checkFileExist(file):
     if not os.path.exists(os.path.abspath(file)):
@@ -52,52 +61,203 @@ def checkOptConflict(replace, delete):
                 '*** ERROR: only one option can be choose between "--replace" and "--delete"')
 
 
-def checkTaxId(taxId):
-    ncbi = NCBITaxa()
-    tmp = ncbi.get_rank([taxId])
+def getNcbiTaxa():
+    # open the taxonomy database only once per process
+    global ncbiTaxa
+    if ncbiTaxa is None:
+        from ete3 import NCBITaxa
+        ncbiTaxa = NCBITaxa()
+    return(ncbiTaxa)
+
+
+def getTaxInfo(taxIds):
+    # get rank and NCBI name of a list of taxon IDs using batched queries
+    ncbi = getNcbiTaxa()
+    ids = [int(t) for t in taxIds if str(t).isdigit()]
     try:
-        tmp = ncbi.get_rank([taxId])
-        rank = tmp[int(taxId)]
+        ranks = ncbi.get_rank(ids)
+        ncbiNames = ncbi.get_taxid_translator(ids)
+    except BaseException:
+        ranks = {}
+        ncbiNames = {}
+    taxInfo = {}
+    for taxId in taxIds:
+        if str(taxId).isdigit() and int(taxId) in ranks:
+            taxInfo[taxId] = (
+                ranks[int(taxId)], ncbiNames.get(int(taxId), ''))
+    return(taxInfo)
+
+
+def checkTaxId(taxId, taxInfo=None):
+    if taxInfo is None:
+        taxInfo = getTaxInfo([taxId])
+    if taxId in taxInfo:
+        (rank, ncbiName) = taxInfo[taxId]
         if not rank == 'species':
             print(
                 '\033[92mWARNING: rank of %s is not SPECIES (%s)\033[0m' %
                 (taxId, rank))
         else:
             print('\033[92mNCBI taxon info: %s %s\033[0m' %
-                  (taxId, ncbi.get_taxid_translator([taxId])[int(taxId)]))
-    except BaseException:
+                  (taxId, ncbiName))
+    else:
         print(
             '\033[92mWARNING: %s not found in NCBI taxonomy database!\033[0m' %
             taxId)
 
 
+def getTaxNames(taxIds):
+    # get fdog taxon names (e.g. HOMSA) for a list of taxon IDs at once
+    taxInfo = getTaxInfo(taxIds)
+    names = {}
+    for taxId in taxIds:
+        try:
+            ncbiName = taxNamePattern.sub('', taxInfo[taxId][1])
+            taxName = ncbiName.split()
+            names[taxId] = taxName[0][:3].upper() + taxName[1][:2].upper()
+        except BaseException:
+            names[taxId] = "UNK" + str(taxId)
+    return(names)
+
+
 def getTaxName(taxId):
-    ncbi = NCBITaxa()
-    try:
-        ncbiName = ncbi.get_taxid_translator([taxId])[int(taxId)]
-        ncbiName = re.sub('[^a-zA-Z1-9\\s]+', '', ncbiName)
-        taxName = ncbiName.split()
-        name = taxName[0][:3].upper() + taxName[1][:2].upper()
-    except BaseException:
-        name = "UNK" + taxId
-    return(name)
+    return(getTaxNames([taxId])[taxId])
+
+
+def iterFasta(faIn):
+    # yield (ID, sequence) of each record, ID is the first word of the header
+    with open(faIn, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:1] == b'>':
+                pos = 0
+            else:
+                pos = mm.find(b'\n>')
+                if pos == -1:
+                    return
+                pos = pos + 1
+            while pos != -1:
+                nxt = mm.find(b'\n>', pos)
+                end = nxt if nxt != -1 else len(mm)
+                header, _, seq = mm[pos + 1:end].partition(b'\n')
+                header = (header.split(None, 1) or [b''])[0].decode()
+                yield(header, seq.translate(None, b' \r\n'))
+                pos = nxt if nxt == -1 else nxt + 1
+
+
+def isCleanFasta(faIn):
+    # check if a FASTA file has only single-line sequences of letters, IDs
+    # without spaces or pipes and no duplicated IDs
+    with open(faIn, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return(False)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if not cleanFastaPattern.fullmatch(mm):
+                return(False)
+            seqIds = headerPattern.findall(mm)
+    return(len(seqIds) == len(set(seqIds)))
+
+
+def writeSpecFile(faIn, specFile, replace, delete, assumeClean=False):
+    with open(specFile, 'wb') as f:
+        # output is collected and written in chunks of about 4 MiB
+        out = bytearray()
+        flushSize = 4 << 20
+        index = 0
+        modIdIndex = 0
+        # longId = 'no'
+        tmpDict = {}
+        seqIds = set()
+        pipeWarning = False
+        # with open(specFile + '.mapping', 'a') as mappingFile:
+        # stream fasta seq
+        for id, seq in iterFasta(faIn):
+            # check ID
+            # oriId = id
+            if ' ' in id:
+                sys.exit(
+                    '\033[91mERROR: Sequence IDs (e.g. %s) must not contain space(s)!\033[0m' %
+                    id)
+            else:
+                if '|' in id:
+                    if not pipeWarning:
+                        print(
+                            '\033[91mWARNING: Sequence IDs contain pipe(s). They will be replaced by "_"!\033[0m')
+                        pipeWarning = True
+                    id = id.replace('|', '_')
+            if id in seqIds:
+                sys.exit(
+                    '\033[91mERROR: Duplicate sequence ID found (%s)!\033[0m' %
+                    id)
+            seqIds.add(id)
+            # if len(id) > 20:
+            #     modIdIndex = modIdIndex + 1
+            #     id = modIdIndex
+            #     longId = 'yes'
+            # if not id in tmpDict:
+            #     tmpDict[id] = 1
+            # else:
+            #     index = index + 1
+            #     id = str(index)
+            #     tmpDict[id] = 1
+            # mappingFile.write('%s\t%s\n' % (id, oriId))
+            # check seq
+            if seq.endswith(b'*'):
+                seq = seq[:-1]
+            specialChr = b''
+            if not assumeClean:
+                specialChr = seq.translate(None, alphaChr)
+            if specialChr:
+                if replace or delete:
+                    if replace:
+                        seq = seq.translate(replaceTable)
+                    if delete:
+                        seq = seq.translate(None, nonAlphaChr)
+                else:
+                    sys.exit(
+                        '\033[91mERROR: %s sequence contains special character!\033[0m\nYou can use --replace or --delete to solve it.' %
+                        (id))
+            out += b'>'
+            out += id.encode()
+            out += b'\n'
+            out += seq
+            out += b'\n'
+            if len(out) >= flushSize:
+                f.write(out)
+                out.clear()
+        if out:
+            f.write(out)
+
+
+def writeCheckedFile(specFile):
+    # write .checked file via a temp file, so that a crash cannot leave a
+    # marker for an incomplete genome file
+    tmpFile = specFile + '.checked.tmp'
+    fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.write(fd, str(datetime.now()).encode())
+    os.close(fd)
+    os.replace(tmpFile, specFile + '.checked')
 
 
 def runBlast(args):
     (specName, specFile, outPath) = args
-    blastCmd = 'makeblastdb -dbtype prot -in %s -out %s/blast_dir/%s/%s' % (
-        specFile, outPath, specName, specName)
+    blastCmd = ['makeblastdb', '-dbtype', 'prot', '-in', specFile, '-out',
+                '%s/blast_dir/%s/%s' % (outPath, specName, specName)]
+    sys.stdout.flush()
     try:
-        subprocess.call([blastCmd], shell=True)
+        blastRun = subprocess.run(blastCmd, check=False)
     except BaseException:
-        sys.exit('Problem with running %s' % blastCmd)
+        sys.exit('Problem with running %s' % ' '.join(blastCmd))
+    if not blastRun.returncode == 0:
+        sys.exit('Problem with running %s' % ' '.join(blastCmd))
     fileInGenome = "../../genome_dir/%s/%s.fa" % (specName, specName)
     fileInBlast = "%s/blast_dir/%s/%s.fa" % (outPath, specName, specName)
     if not Path(fileInBlast).exists():
         os.symlink(fileInGenome, fileInBlast)
 
 
-def main():
+def getParser():
     version = '0.0.10'
     parser = argparse.ArgumentParser(
         description='You are running fdog.addTaxon version ' +
@@ -168,14 +328,20 @@ def main():
         help='Delete special characters in sequences',
         action='store_true',
         default=False)
+    optional.add_argument(
+        '--assumeClean',
+        help='Do not check sequences for special characters',
+        action='store_true',
+        default=False)
     optional.add_argument(
         '--force',
         help='Force overwrite existing data',
         action='store_true',
         default=False)
+    return(parser)
 
-    args = parser.parse_args()
 
+def run(args, makeBlast=True, taxInfo=None):
     checkFileExist(args.fasta)
     faIn = args.fasta
     name = args.name.upper()
@@ -202,10 +368,11 @@ def main():
     replace = args.replace
     delete = args.delete
     checkOptConflict(replace, delete)
+    assumeClean = args.assumeClean
     force = args.force
 
     # species name after fdog naming scheme
-    checkTaxId(taxId)
+    checkTaxId(taxId, taxInfo)
     if name == "":
         name = getTaxName(taxId)
     specName = name + '@' + taxId + '@' + ver
@@ -220,102 +387,86 @@ def main():
 
     # create file in genome_dir
     print('Parsing FASTA file...')
-    Path(outPath + '/genome_dir').mkdir(parents=True, exist_ok=True)
     genomePath = outPath + '/genome_dir/' + specName
+    newGenomePath = not os.path.isdir(genomePath)
     Path(genomePath).mkdir(parents=True, exist_ok=True)
-    # load fasta seq
-    inSeq = SeqIO.to_dict((SeqIO.parse(open(faIn), 'fasta')))
     specFile = genomePath + '/' + specName + '.fa'
-    if (not os.path.exists(os.path.abspath(specFile))) or (
-            os.stat(specFile).st_size == 0) or force:
-        f = open(specFile, 'w')
-        index = 0
-        modIdIndex = 0
-        # longId = 'no'
-        tmpDict = {}
-        # with open(specFile + '.mapping', 'a') as mappingFile:
-        for id in inSeq:
-            seq = str(inSeq[id].seq)
-            # check ID
-            # oriId = id
-            if ' ' in id:
-                sys.exit(
-                    '\033[91mERROR: Sequence IDs (e.g. %s) must not contain space(s)!\033[0m' %
-                    id)
+    try:
+        specSize = os.stat(specFile).st_size
+    except FileNotFoundError:
+        specSize = 0
+    if specSize == 0 or force:
+        try:
+            if isCleanFasta(faIn):
+                # input can be used as it is
+                shutil.copyfile(faIn, specFile)
             else:
-                if '\\|' in id:
-                    print(
-                        '\033[91mWARNING: Sequence IDs contain pipe(s). They will be replaced by "_"!\033[0m')
-                    id = re.sub('\\|', '_', id)
-            # if len(id) > 20:
-            #     modIdIndex = modIdIndex + 1
-            #     id = modIdIndex
-            #     longId = 'yes'
-            # if not id in tmpDict:
-            #     tmpDict[id] = 1
-            # else:
-            #     index = index + 1
-            #     id = str(index)
-            #     tmpDict[id] = 1
-            # mappingFile.write('%s\t%s\n' % (id, oriId))
-            # check seq
-            if seq[-1] == '*':
-                seq = seq[:-1]
-            specialChr = 'no'
-            if any(c for c in seq if not c.isalpha()):
-                specialChr = 'yes'
-            if specialChr == 'yes':
-                if replace or delete:
-                    if replace:
-                        seq = re.sub('[^a-zA-Z]', 'X', seq)
-                    if delete:
-                        seq = re.sub('[^a-zA-Z]', '', seq)
-                else:
-                    sys.exit(
-                        '\033[91mERROR: %s sequence contains special character!\033[0m\nYou can use --replace or --delete to solve it.' %
-                        (id))
-            f.write('>%s\n%s\n' % (id, seq))
-        f.close()
-        # write .checked file
-        cf = open(specFile + '.checked', 'w')
-        cf.write(str(datetime.now()))
-        cf.close()
+                writeSpecFile(faIn, specFile, replace, delete, assumeClean)
+        except BaseException:
+            # do not leave an incomplete genome file (or a new empty taxon
+            # folder) behind, otherwise it would be skipped in the next run
+            if newGenomePath:
+                shutil.rmtree(genomePath, ignore_errors=True)
+            elif os.path.exists(specFile):
+                os.remove(specFile)
+            raise
+        writeCheckedFile(specFile)
         # warning about long header
         # if longId == 'yes':
         #     print('\033[91mWARNING: Some headers longer than 80 characters have been automatically shortened. PLease check the %s.mapping file for details!\033[0m' % specFile)
     else:
         print(genomePath + '/' + specName + '.fa already exists!')
 
-    # create blast db
+    # create blast db (or return the job if makeBlast is False)
+    blastJob = None
+    errors = []
     if coreTaxa:
-        print('Creating Blast DB...')
         Path(outPath + '/blast_dir').mkdir(parents=True, exist_ok=True)
-        if (not os.path.exists(os.path.abspath(outPath + '/blast_dir/' + \
-            specName + '/' + specName + '.phr'))) or force:
-            try:
-                runBlast([specName, specFile, outPath])
-            except BaseException:
-                print('\033[91mProblem with creating BlastDB.\033[0m')
+        if force or not os.path.exists(
+                outPath + '/blast_dir/' + specName + '/' + specName + '.phr'):
+            if makeBlast:
+                print('Creating Blast DB...')
+                try:
+                    runBlast([specName, specFile, outPath])
+                except BaseException:
+                    print('\033[91mProblem with creating BlastDB.\033[0m')
+                    errors.append('creating BlastDB')
+            else:
+                blastJob = [specName, specFile, outPath]
         else:
             print('Blast DB already exists!')
 
     # create annotation
     if not noAnno:
         Path(outPath + '/weight_dir').mkdir(parents=True, exist_ok=True)
-        annoCmd = 'fas.doAnno -i %s/%s.fa -o %s --cpus %s' % (
-            genomePath, specName, outPath + '/weight_dir', cpus)
+        annoCmd = ['fas.doAnno', '-i', '%s/%s.fa' % (genomePath, specName),
+                   '-o', outPath + '/weight_dir', '--cpus', str(cpus)]
         if force:
-            annoCmd = annoCmd + " --force"
+            annoCmd.append('--force')
+        sys.stdout.flush()
         try:
-            subprocess.call([annoCmd], shell=True)
+            annoRun = subprocess.run(annoCmd, check=False)
+            annoDone = annoRun.returncode == 0
         except BaseException:
+            annoDone = False
+        if not annoDone:
             print(
                 '\033[91mProblem with running fas.doAnno. You can check it with this command:\n%s\033[0m' %
-                annoCmd)
+                ' '.join(annoCmd))
+            errors.append('running fas.doAnno')
 
     print(
         'Output for %s can be found in %s within genome_dir [and blast_dir, weight_dir] folder[s]' %
         (specName, outPath))
+    if len(errors) > 0:
+        sys.exit('\033[91mProblem with %s for %s!\033[0m' %
+                 (' and '.join(errors), specName))
+    return(blastJob)
+
+
+def main():
+    args = getParser().parse_args()
+    run(args)
 
 
 if __name__ == '__main__':